@@ -22,48 +22,173 @@ Created by: Winter Johnson on 6/7/23
 """
 
 import matplotlib.pyplot as plt
-from operator import mul
-from functools import reduce
+import numpy as np
+from functools import lru_cache
+from collections import Counter
+import itertools
 import time
 import math
+import re
 
+# Past this many outcomes the count map is no longer exact in
+# float64 (and soon overflows int64), so use fftDiceCall
+EXACT_LIMIT = 2**53
 
-def diceMap(diceList: list[int], rec: bool=False) -> list[int]:
+# Below this length for the shorter count map, direct
+# convolution beats an FFT, see convolveCall
+FFT_CROSSOVER = 150
+
+# Past this map length, large hands are summed with fftDiceCall
+# instead of probDiceCall's direct float64 convolutions
+FFT_LIMIT = 2**15
+
+def diceMap(diceList: list[int], rec: bool=False) -> np.ndarray:
     """
     Insert list of dice to be roled as ints rep max face value:
     1d4 + 2d6 -> [4, 6, 6] (order unimportant).
+    rec=True returns the count map, only for hands with at most
+    EXACT_LIMIT outcomes, past that counts overflow int64.
     """
 
-    # responsible for recording the number of times each value appears
-    probArray = [0]*(sum(diceList)-len(diceList)+1)
+    return diceMapGrouped(Counter(diceList).items(), rec)
+
+def diceMapGrouped(groups: list[tuple[int, int]], rec: bool=False) -> np.ndarray:
+    """
+    Same as diceMap but takes the hand as (face, count) pairs:
+    1d4 + 2d6 -> [(4, 1), (6, 2)], so 100d6 is one pair
+    instead of a 100 long list.
+    """
+
+    # Merge repeated faces and sort so equal hands share a cache entry,
+    # 0 dice of a face add nothing so those are dropped
+    merged = Counter()
+    for face, count in groups:
+        if face < 1 or count < 0:
+            raise ValueError(f"Invalid dice group: {count}d{face}")
+        merged[face] += count
+    groupTup = tuple(sorted((face, count) for face, count in merged.items() if count))
+
+    if not groupTup:
+        raise ValueError("Empty dice hand")
+
+    if rec and math.prod(face**count for face, count in groupTup) > EXACT_LIMIT:
+        raise ValueError("count map too large for int64, use rec=False")
+
+    # Copy so callers can't modify the cached array
+    return _diceMapGrouped(groupTup, rec).copy()
+
+@lru_cache(maxsize=None)
+def _diceMapGrouped(groups: tuple[tuple[int, int], ...], rec: bool) -> np.ndarray:
+    """
+    Memoized back-end for diceMapGrouped, takes a sorted tuple so
+    both repeated hands and shared sub-hands are only computed once.
+    """
 
     # Total number of possible outcomes (product of input)
-    div = reduce(mul, diceList)
+    div = math.prod(face**count for face, count in groups)
 
+    if not rec and div > EXACT_LIMIT: # large hand, counts overflow int64
+        length = sum((face-1)*count for face, count in groups)+1
+        if length > FFT_LIMIT: # direct convolution too slow, sum in frequency domain
+            return fftDiceCall(groups)
+        return probDiceCall(groups)
 
-    if len(diceList) == 1: # 1 dice, easy probability
-        return [1/diceList[0] for _ in range(diceList[0])]
-    
-    elif len(diceList) > 2: # recursive case TODO Add protection for too much recursion (limit on dice size?)
+    elif len(groups) == 1: # all the same die
+        probArray = groupDiceCall(*groups[0])
 
-        # rec=true returns the count map (not probability)
-        tmp = diceMap(diceList=diceList[1:], rec=True)
+    elif len(groups) == 2 and groups[0][1] == groups[1][1] == 1: # 2 different dice
+        probArray = doubleDiceCall(groups[0][0], groups[1][0])
 
-        # performs back-end logic
-        for probOffset in range(diceList[0]):
-            for placeIndex in range(len(tmp)):
-                probArray[placeIndex + probOffset] += tmp[placeIndex]
+    else: # recursive case, split in half so depth is log2(len)
 
-    else: # Base case, 2 dice
-        probArray = doubleDiceCall(diceList[0], diceList[1])
+        # rec=true returns the count map (not probability)
+        mid = len(groups)//2
+        left = _diceMapGrouped(groups[:mid], True)
+        right = _diceMapGrouped(groups[mid:], True)
+
+        # performs back-end logic: the count map of two hands summed
+        # is the convolution of their count maps
+        probArray = convolveCall(left, right)
 
     if rec:
         return probArray
-    return [i/div for i in probArray]
 
-def doubleDiceCall(n: int, m: int) -> list[int]:
+    # float32 is plenty for plotting, and half the memory of float64
+    return probArray.astype(np.float32) / np.float32(div)
+
+@lru_cache(maxsize=None)
+def groupDiceCall(face: int, count: int) -> np.ndarray:
+    """
+    Helper function for diceMapGrouped. Count map of count dice
+    with the same face, cached so hands sharing e.g. 3d6 only
+    build it once. Splits count in half, the two halves differ
+    by at most 1 so only log2(count) maps are ever built.
+    """
+
+    if count == 1: # 1 dice, every face counted once
+        countRet = np.ones(face, dtype=np.int64)
+
+    elif count == 2: # Base case, 2 dice
+        return doubleDiceCall(face, face)
+
+    else:
+        countRet = convolveCall(groupDiceCall(face, count//2),
+                                groupDiceCall(face, count - count//2))
+
+    # Cached and shared between callers, so don't allow edits
+    countRet.setflags(write=False)
+    return countRet
+
+@lru_cache(maxsize=None)
+def probDiceCall(groups: tuple[tuple[int, int], ...]) -> np.ndarray:
+    """
+    Helper function for diceMapGrouped on large hands, whose
+    counts overflow int64. Same halving as _diceMapGrouped and
+    groupDiceCall, but convolving float64 probability maps, so
+    even the far tails keep ~1e-15 relative error.
+    Sub-hands within EXACT_LIMIT start from their exact counts.
+    Returns float64, float32 would underflow the tails of e.g. 60d6.
     """
-    Helper function for above. Only needs to return
+
+    div = math.prod(face**count for face, count in groups)
+
+    if div <= EXACT_LIMIT:
+        probRet = _diceMapGrouped(groups, True) / div
+
+    else:
+        if len(groups) == 1: # all the same die, split the count
+            face, count = groups[0]
+            left, right = ((face, count//2),), ((face, count - count//2),)
+        else: # split the faces
+            mid = len(groups)//2
+            left, right = groups[:mid], groups[mid:]
+        probRet = np.convolve(probDiceCall(left), probDiceCall(right))
+
+    # Cached and shared between callers, so don't allow edits
+    probRet.setflags(write=False)
+    return probRet
+
+def convolveCall(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Helper function, convolves two count maps with whichever
+    method is faster: direct for short maps, FFT once both are
+    long. Callers only pass count maps of hands within
+    EXACT_LIMIT (diceMapGrouped refuses larger ones with rec=True),
+    so rounding the FFT result back to ints is exact.
+    """
+
+    if min(len(a), len(b)) < FFT_CROSSOVER:
+        return np.convolve(a, b)
+
+    length = len(a)+len(b)-1
+    n = 1 << (length-1).bit_length() # pad to power of 2, no wrap-around
+    countRet = np.fft.irfft(np.fft.rfft(a, n)*np.fft.rfft(b, n), n)[:length]
+    return np.rint(countRet).astype(np.int64)
+
+@lru_cache(maxsize=None)
+def doubleDiceCall(n: int, m: int) -> np.ndarray:
+    """
+    Helper function for diceMapGrouped. Only needs to return
     count map of 2 dice rolling
     1 2 3 4 . .
     -------
@@ -79,21 +204,40 @@ def doubleDiceCall(n: int, m: int) -> list[int]:
         3, 3 -> [1, 2, 3, 2, 1]
     """
 
-    countRet = [None]*(n+m-1)
+    countRet = np.empty(n+m-1, dtype=np.int64)
     maxCount = min(m, n)
 
-    # Symmetry allows for mirrored calculations
-    for i in range(math.ceil(len(countRet)/2)):
+    # Ramp up, ramp down (overlapping in the middle when n == m),
+    # and a flat top at maxCount in between
+    countRet[:maxCount] = np.arange(1, maxCount+1)
+    countRet[-maxCount:] = np.arange(maxCount, 0, -1)
+    countRet[maxCount:-maxCount] = maxCount
+
+    # Cached and shared between callers, so don't allow edits
+    countRet.setflags(write=False)
+    return countRet
+
+def fftDiceCall(groups: list[tuple[int, int]]) -> np.ndarray:
+    """
+    Helper function for diceMapGrouped on hands past FFT_LIMIT,
+    where probDiceCall's direct convolutions get too slow. Summing
+    dice multiplies their polynomials, which after an FFT is just a
+    pointwise product of each die's spectrum: O(S log S).
+    Round-off gives an absolute error of about 1e-17 on every
+    entry, so tail probabilities below that come back as noise
+    or 0, only the bulk of the map is accurate.
+    """
 
-        if i >= maxCount:
-            countRet[i] = maxCount
-            countRet[len(countRet)-1-i] = maxCount
+    length = sum((face-1)*count for face, count in groups)+1
+    n = 1 << (length-1).bit_length() # pad to power of 2, no wrap-around
 
-        else:
-            countRet[i] = i + 1
-            countRet[len(countRet)-1-i] = i + 1
+    # Identical dice share a spectrum, raise it to the count
+    spectrum = np.ones(n//2+1, dtype=complex)
+    for face, count in groups:
+        spectrum *= np.fft.rfft(np.full(face, 1/face), n)**count
 
-    return countRet
+    # Round-off leaves tiny negatives in the tails
+    return np.clip(np.fft.irfft(spectrum, n)[:length], 0, None)
 
 def dNumTranslator(dformat: str) -> list[int]:
     """
@@ -102,12 +246,24 @@ def dNumTranslator(dformat: str) -> list[int]:
     int: [4, 6, 6, ..]
     """
 
-    toReturn = []
-    for di in dformat.split('+'):
-        tmp = di.strip().split('d')
-        for _ in range(int(tmp[0])):
-            toReturn.append(int(tmp[1]))
-    return toReturn
+    return list(itertools.chain.from_iterable(
+        [face]*count for face, count in dNumGrouper(dformat)))
+
+def dNumGrouper(dformat: str) -> list[tuple[int, int]]:
+    """
+    Helper function, translates normal format of
+    dice hands: 1d4 + 2d6 + ... to (face, count)
+    pairs: [(4, 1), (6, 2), ..] without expanding them.
+    Raises ValueError on any term that isn't #d#.
+    """
+
+    groups = []
+    for term in dformat.split('+'):
+        match = re.fullmatch(r'\s*(\d+)\s*d\s*(\d+)\s*', term)
+        if match is None or int(match[1]) < 1 or int(match[2]) < 1:
+            raise ValueError(f"Invalid dice term: '{term.strip()}'")
+        groups.append((int(match[2]), int(match[1])))
+    return groups
 
 
 COMMANDS = """
@@ -126,13 +282,16 @@ if __name__ == "__main__":
     plt.ion()
     gameOn = True
 
-    # Main dice and lines collection variable
-    dice = [[6, 6]]
+    # Main dice and lines collection variables, kept in parallel:
+    # each hand, its (x, y) data computed once on add, and its line
+    # Hands are kept as (face, count) pairs, see dNumGrouper
+    dice = [[(6, 2)]]
+    linesData = [(np.arange(2, 13), diceMapGrouped(dice[0]))]
 
     # Og figure
     fig = plt.figure()
     ax = fig.add_subplot()
-    linetmp, = ax.plot([i for i in range(2, 13)], diceMap(dice[0]), marker='.', label="2d6")
+    lines = [ax.plot(*linesData[0], marker='.', label="2d6")[0]]
 
     plt.xlabel("Sum total")
     plt.ylabel("Probability")
@@ -151,7 +310,7 @@ if __name__ == "__main__":
 
         # Print all dice hands
         for hand in range(len(dice)):
-            print(str(hand) + ")", dice[hand])
+            print(str(hand) + ")", " + ".join(f"{count}d{face}" for face, count in dice[hand]))
         
         userIn = input('Command: ')
 
@@ -161,23 +320,39 @@ if __name__ == "__main__":
 
         elif userIn[:3] == "del":
             if len(userIn) > 4:
-                linetmp.remove() # TODO method doesn't exist
-                dice.remove(int(userIn[4:]))
+                try:
+                    hand = int(userIn[4:])
+                    if not 0 <= hand < len(dice):
+                        raise IndexError(hand)
+                except (ValueError, IndexError):
+                    print("Invalid input!")
+                    continue
+                lines.pop(hand).remove()
+                linesData.pop(hand)
+                dice.pop(hand)
                 plt.legend()
 
         elif userIn[:3] == "add":
             if len(userIn) > 4:
-                userInTrans = dNumTranslator(userIn[4:])
-                x = [i for i in range(len(userInTrans), sum(userInTrans)+1)]
-                lineTemp, = ax.plot(x, diceMap(userInTrans), marker='.', label=userIn[4:])
+                try:
+                    userInTrans = dNumGrouper(userIn[4:])
+                except ValueError:
+                    print("Invalid input!")
+                    continue
+                x = np.arange(sum(count for _, count in userInTrans),
+                              sum(face*count for face, count in userInTrans)+1)
+                linesData.append((x, diceMapGrouped(userInTrans)))
+                lines.append(ax.plot(*linesData[-1], marker='.', label=userIn[4:])[0])
                 dice.append(userInTrans)
                 plt.legend()
 
         elif userIn[:3] == "qit":
             gameOn = False
+            continue
 
         elif userIn[:3] == "hlp":
             print(COMMANDS)
+            continue # nothing changed, no redraw
 
         else:
             print("Invalid input!")